@@ -26,14 +26,17 @@ NIST.  But this data is stored (in the "downloaded_data" subdirectory) so that
 subsequent runs do not require downloading the data.
 """
 
+import concurrent.futures
+import glob
+import io
+import json
 import os.path
 from collections import namedtuple
-from collections import OrderedDict
-import pickle
 import urllib.request, urllib.error, urllib.parse
 import numpy as np
 import scipy.constants as sc
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
 
 """Through inspection of the html page:
   http://webbook.nist.gov/chemistry/fluid/
@@ -120,105 +123,223 @@ species = {
 }
 
 
-def download_data():
-    """Download thermodynamic fluid data from:
-      http://webbook.nist.gov/chemistry/fluid/
-    for each species, putting the downloaded data files in the subdirectory:
-      "./downloaded_data"
-    """
+# the columns of the NIST data files, in order:
+C = namedtuple("C", "pos full_name units short_name")
+amap = (
+    C(0, "Temperature", "K", "temperature"),
+    C(1, "Pressure", "MPa", "pressure"),
+    C(2, "Density", "mol/l", "density"),
+    C(3, "Volume", "l/mol", "volume"),
+    C(4, "Internal Energy", "kJ/mol", "internal_energy"),
+    C(5, "Enthalpy", "kJ/mol", "enthalpy"),
+    C(6, "Entropy", "J/mol*K", "entropy"),
+    C(7, "Cv", "J/mol*K", "cv"),
+    C(8, "Cp", "J/mol*K", "cp"),
+    C(9, "Sound Spd.", "m/s", "sound_speed"),
+    C(10, "Joule-Thomson", "K/MPa", "joule_thomson"),
+    C(11, "Viscosity", "uPa*s", "viscosity"),
+    C(12, "Therm. Cond.", "W/m*K", "thermal_conductivity"),
+    C(13, "Phase", "", "phase"),
+)
+
+
+def _data_url(akey):
+    """The URL requesting the full isobar data for a single species."""
     # The code requests data for each molecule over a range of temperatures
     # using a single URL (with a part that changes for each molecule).  The
     # form for the required URLs was determined by interactively generating
     # a manual request for the data of a single specific molecule using a
     # web-browser and then examining the specific URL.
+    return (
+        r"http://webbook.nist.gov/cgi/fluid.cgi?Action=Data&Wide=on&ID="
+        + akey
+        + r"&Type=IsoBar&Digits=5&P=0&THigh=1000&TLow=0&TInc=1&"
+        + r"RefState=DEF&TUnit=K&PUnit=MPa&DUnit=mol%2Fl&HUnit=kJ%2Fmol&W"
+        + r"Unit=m%2Fs&VisUnit=uPa*s&STUnit=N%2Fm"
+    )
 
-    # for each species, request data and write it to file:
-    keys = list(species.keys())
-    for i, akey in enumerate(keys):
-        print("Downloading %d of %d, key: %s" % (i + 1, len(keys), akey))
-        raw = (
-            r"http://webbook.nist.gov/cgi/fluid.cgi?Action=Data&Wide=on&ID="
-            + akey
-            + r"&Type=IsoBar&Digits=5&P=0&THigh=1000&TLow=0&TInc=1&"
-            + r"RefState=DEF&TUnit=K&PUnit=MPa&DUnit=mol%2Fl&HUnit=kJ%2Fmol&W"
-            + r"Unit=m%2Fs&VisUnit=uPa*s&STUnit=N%2Fm"
-        )
-        response = urllib.request.urlopen(raw)
-        page_text = response.read()  # these pages are just plain text --- not html
-        apath = os.path.join(os.path.dirname(__file__),
-            "downloaded_data")
 
-        if not os.path.exists(apath):
-            os.makedirs(apath)
+def download_data():
+    """Download thermodynamic fluid data from:
+      http://webbook.nist.gov/chemistry/fluid/
+    for each species, putting the downloaded data files in the subdirectory:
+      "./downloaded_data"
+    """
+    apath = os.path.join(os.path.dirname(__file__),
+        "downloaded_data")
+    os.makedirs(apath, exist_ok=True)
 
+    def _fetch(akey):
+        """Request the data for a single species and write it to file.
+        Species whose data is already on disk (e.g. from an earlier,
+        interrupted run) are not fetched again.
+        """
         fname_with_path = os.path.join(apath, akey + "_generated.txt")
+        if (os.path.exists(fname_with_path)
+                and os.path.getsize(fname_with_path) > 0):
+            return akey
+
+        response = urllib.request.urlopen(_data_url(akey), timeout=30)
+        page_text = response.read()  # these pages are just plain text --- not html
+
         with open(fname_with_path, "w") as f:
             f.write(page_text.decode())
+        return akey
 
+    # the downloads are dominated by network latency, so fetch several
+    # species concurrently:
+    keys = tuple(species)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=16) as ex:
+        for i, akey in enumerate(ex.map(_fetch, keys)):
+            print("Downloaded %d of %d, key: %s" % (i + 1, len(keys), akey))
 
-def create_pickle_file():
-    """Creates a *.pickle file from downloaded thermodynamic data in subdirectory:
-     downloaded_data/
-    The data in downloaded_data should be downloaded prior to running this script,
-    by running
-     0_download_data.py
-    """
-
-    C = namedtuple("C", "pos full_name units short_name")
-
-    amap = [
-        C(0, "Temperature", "K", "temperature"),
-        C(1, "Pressure", "MPa", "pressure"),
-        C(2, "Density", "mol/l", "density"),
-        C(3, "Volume", "l/mol", "volume"),
-        C(4, "Internal Energy", "kJ/mol", "internal_energy"),
-        C(5, "Enthalpy", "kJ/mol", "enthalpy"),
-        C(6, "Entropy", "J/mol*K", "entropy"),
-        C(7, "Cv", "J/mol*K", "cv"),
-        C(8, "Cp", "J/mol*K", "cp"),
-        C(9, "Sound Spd.", "m/s", "sound_speed"),
-        C(10, "Joule-Thomson", "K/MPa", "joule_thomson"),
-        C(11, "Viscosity", "uPa*s", "viscosity"),
-        C(12, "Therm. Cond.", "W/m*K", "thermal_conductivity"),
-        C(13, "Phase", "", "phase"),
-    ]
 
-    # read in data for each species and load it into a dictionary:
-    d = OrderedDict()
-    for akey, name in list(species.items()):
-        d[akey] = OrderedDict()
-        sd = d[akey]
-        sd["name"] = np.string_(name)
-        for column in amap:
-            sd[column.short_name] = []
+def _parse_species_text(text):
+    """Parse the text of one NIST data file into a dictionary mapping
+    column names to 1-d arrays.
+    """
+    sd = {}
+
+    # parse all numeric columns in a single vectorized call rather
+    # than looping over lines in Python.  np.loadtxt tokenizes in
+    # C, but cannot handle the non-numeric entries ("undefined",
+    # "infinite") that appear in some columns of the NIST files, so
+    # rewrite those as "nan" before parsing (the first line is the
+    # column headings):
+    text = text.split("\n", 1)[1].replace("undefined", "nan").replace(
+        "infinite", "nan")
+    # the data is only requested to 5 significant digits
+    # ("Digits=5" in the URL), so single precision (~7 digits) is
+    # plenty, and halves the size of the cached arrays:
+    arr = np.loadtxt(io.StringIO(text), usecols=range(13),
+        dtype=np.float32)
+    for column in amap[:-1]:
+        sd[column.short_name] = arr[:, column.pos]
+    # the final "Phase" column is text rather than numeric:
+    sd["phase"] = np.loadtxt(io.StringIO(text), usecols=13, dtype="U16")
+
+    # make_plot graphs Cv in units of N*k_B/2, so store the scaled
+    # values rather than rescaling on every plot:
+    sd["cv_scaled"] = sd["cv"] * np.float32(2.0 / (sc.N_A * sc.k))
+    return sd
+
+
+def _write_data_archive(d, apath, columns=None):
+    """Write the dictionary of per-species column dictionaries "d" to
+    the cached *.npz archive (plus the *.json file of species names)
+    in directory "apath".  If "columns" is given, only the named
+    columns are persisted.
+    """
+    # stack each column across all species into a single 2-d array of
+    # shape (species, temperatures), padding shorter curves with nan
+    # ("" for the phase strings).  One array per column (rather than
+    # one per species and column) lets whole-dataset operations work as
+    # single vectorized expressions and keeps the archive small:
+    keys = tuple(species)
+    n_temperatures = max(len(sd["temperature"]) for sd in d.values())
+    stacked = {"keys": np.array(keys)}
+    column_names = [column.short_name for column in amap] + ["cv_scaled"]
+    if columns is not None:
+        column_names = [column_name for column_name in column_names
+                        if column_name in columns]
+    for column_name in column_names:
+        dtype = d[keys[0]][column_name].dtype
+        fill = "" if dtype.kind == "U" else np.nan
+        a = np.full((len(keys), n_temperatures), fill, dtype=dtype)
+        for i, akey in enumerate(keys):
+            values = d[akey][column_name]
+            a[i, : len(values)] = values
+        stacked[column_name] = a
+    # the smooth numeric data deflates well, so trading a little
+    # decompression CPU for much less disk I/O is a net win on load:
+    np.savez_compressed(
+        os.path.join(apath, "nist_fluid_data_generated.npz"), **stacked)
+
+    # the species names are kept in a *.json file alongside the arrays:
+    with open(os.path.join(apath, "nist_fluid_names_generated.json"),
+              "w") as f:
+        json.dump(species, f, indent=1)
+
+
+def create_pickle_file(columns=("temperature", "cv", "cv_scaled")):
+    """Creates a *.npz archive (plus a *.json file of species names) from
+    downloaded thermodynamic data in subdirectory:
+     downloaded_data/
+    The data in downloaded_data should be downloaded prior to running this
+    script, by running "download_data".
 
-        apath = os.path.join(os.path.dirname(__file__),
-            "downloaded_data")
+    By default only the columns that make_plot consumes are persisted;
+    pass columns=None to keep the complete dataset (e.g. for analyses
+    outside this script).
+    """
+    apath = os.path.join(os.path.dirname(__file__),
+        "downloaded_data")
 
+    d = {}
+    for akey in species:
         with open(os.path.join(apath, akey + "_generated.txt"), "r") as f:
-            f.readline()
-            for i, line in enumerate(f.readlines()):
-                data = line.split()
-                for column in amap:
-                    try:
-                        num = float(data[column.pos])
-                    except ValueError:
-                        num = float("nan")
-                    sd[column.short_name].append(num)
-        for column in amap:
-            sd[column.short_name] = np.array(sd[column.short_name])
-
-    with open(os.path.join(apath, "nist_fluid_data_generated.pickle"),
-              "wb") as f:
-        pickle.dump(d, f)
-
-def load_pickled_data():
+            d[akey] = _parse_species_text(f.read())
+    _write_data_archive(d, apath, columns=columns)
+
+
+def fetch_and_parse(keep_raw=False,
+                    columns=("temperature", "cv", "cv_scaled")):
+    """Download the data for all species and build the cached archive
+    directly from the in-memory responses, avoiding a write/reread of
+    the raw text through the filesystem.  If "keep_raw" is true, the
+    raw text files are also written to the "downloaded_data"
+    subdirectory (e.g. for analyses outside this script).  "columns"
+    selects which columns are persisted, as in create_pickle_file.
+    """
+    apath = os.path.join(os.path.dirname(__file__),
+        "downloaded_data")
+    os.makedirs(apath, exist_ok=True)
+
+    def _fetch(akey):
+        response = urllib.request.urlopen(_data_url(akey), timeout=30)
+        return akey, response.read().decode()
+
+    # the downloads are dominated by network latency, so fetch several
+    # species concurrently, parsing each response as it arrives:
+    d = {}
+    keys = tuple(species)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=16) as ex:
+        for i, (akey, text) in enumerate(ex.map(_fetch, keys)):
+            print("Downloaded %d of %d, key: %s" % (i + 1, len(keys), akey))
+            d[akey] = _parse_species_text(text)
+            if keep_raw:
+                with open(os.path.join(apath, akey + "_generated.txt"),
+                          "w") as f:
+                    f.write(text)
+    _write_data_archive(d, apath, columns=columns)
+
+
+def load_pickled_data(columns=None):
+    """Load the cached data, returning a dictionary with:
+      "keys": the species key of each row,
+      "names": the corresponding species names,
+    and, per column, a 2-d array of shape (species, temperatures) in
+    which shorter curves are padded with nan.  If "columns" is given,
+    only the named columns are read from the archive, avoiding moving
+    unused data from disk into memory.
+    """
     apath = os.path.join(os.path.dirname(__file__),
         "downloaded_data")
 
-    with open(os.path.join(apath, "nist_fluid_data_generated.pickle"),
-              "rb") as f:
-        d = pickle.load(f)
+    with open(os.path.join(apath, "nist_fluid_names_generated.json"),
+              "r") as f:
+        names = json.load(f)
+
+    # arrays in a .npz archive are only read when accessed:
+    z = np.load(os.path.join(apath, "nist_fluid_data_generated.npz"))
+    keys = [str(akey) for akey in z["keys"]]
+    d = {"keys": keys, "names": [names[akey] for akey in keys]}
+    for column_name in z.files:
+        if column_name == "keys":
+            continue
+        if (columns is not None) and (column_name not in columns):
+            continue
+        d[column_name] = z[column_name]
     return d
 
 def make_plot():
@@ -228,7 +349,19 @@ def make_plot():
     to avoid triggering "if __name__ == "__main__": code
     """
 
-    d = load_pickled_data()
+    # only the temperature and scaled heat capacity columns are plotted:
+    d = load_pickled_data(columns=("temperature", "cv_scaled"))
+    keys = d["keys"]
+    row = {akey: i for i, akey in enumerate(keys)}  # species key -> row
+    T = d["temperature"]
+    CV = d["cv_scaled"]
+
+    # the 1 K temperature grid is several times finer than the figure
+    # resolves, so stride each curve down to ~500 points before it is
+    # handed to matplotlib:
+    stride = max(1, T.shape[1] // 500)
+    T = T[:, ::stride]
+    CV = CV[:, ::stride]
 
     # for clarity, don't plot:
     dont_plot = [
@@ -440,16 +573,13 @@ def make_plot():
 
     plotted = []  # to keep track of what we have plotted
 
-    # define conversion factor for heat capacities:
-    cv_conversion_factor = 2.0 / (sc.N_A * sc.k)
-
     # plot everything that has a special label:
     for special in specials:
         plotted.append(special.nist_key)
-        sd = d[special.nist_key]
+        i = row[special.nist_key]
         axes.plot(
-            sd["temperature"],
-            sd["cv"] * cv_conversion_factor,
+            T[i],
+            CV[i],
             label=special.nist_key,
             color=special.line_color,
             linestyle=special.line_style,
@@ -457,21 +587,23 @@ def make_plot():
         )
 
     # plot everything that is not being deliberately excluded that
-    # has not been plotted yet:
-    for k in list(d.keys()):
-        sd = d[k]
-        if (k not in dont_plot) and (k not in plotted):
-            axes.plot(
-                sd["temperature"],
-                sd["cv"] * cv_conversion_factor,
-                label=k,
-                alpha=0.25,
-                color="k",
-            )
+    # has not been plotted yet.  These curves share a single style, so
+    # batch them into one LineCollection (a single artist) rather than
+    # creating ~60 individual Line2D's:
+    segments = [
+        np.column_stack((T[row[k]], CV[row[k]]))
+        for k in keys
+        if (k not in dont_plot) and (k not in plotted)
+    ]
+    axes.add_collection(LineCollection(
+        segments,
+        colors="k",
+        alpha=0.25,
+        linewidths=plt.rcParams["lines.linewidth"],
+    ))
 
     # place labels for species:
     def place(special):
-        sd = d[special.nist_key]
         axes = plt.gca()
         if (special.position[0] != 0) and (special.position[1] != 0):
             ann = axes.annotate(
@@ -509,20 +641,34 @@ if __name__ == "__main__":
     style_file = os.path.splitext(__file__)[0] + ".mplstyle"
     output_filename = os.path.splitext(__file__)[0] + "_generated.pdf"
 
-    tries = 0
-    max_tries = 2
-    while (tries < max_tries):
-        tries += 1
-        try:
-            with plt.style.context(style_file):
-                make_plot()
-                # use output filename based on script filename:
-                plt.savefig(output_filename)
-            break
-        except FileNotFoundError as e:
-            print("downloading data")
-            download_data()
-            print("creating pickle file")
+    # make sure the cached archive exists and is current before any
+    # plotting starts (rather than plotting, catching the missing-file
+    # error, and starting over):
+    apath = os.path.join(os.path.dirname(__file__), "downloaded_data")
+    npz_path = os.path.join(apath, "nist_fluid_data_generated.npz")
+    raw_files = glob.glob(os.path.join(apath, "*_generated.txt"))
+    if not os.path.exists(npz_path):
+        missing = [akey for akey in species
+                   if not os.path.exists(
+                       os.path.join(apath, akey + "_generated.txt"))]
+        if len(missing) == len(species):
+            print("downloading and parsing data")
+            fetch_and_parse()
+        else:
+            # some raw text files are already on disk; fill in any
+            # gaps and build the cache from them:
+            if missing:
+                print("downloading missing data")
+                download_data()
+            print("creating cache from downloaded data")
             create_pickle_file()
-    else:
-        print(f"Failed after: {max_tries} tries")
+    elif (raw_files
+          and (os.path.getmtime(npz_path)
+               < max(os.path.getmtime(p) for p in raw_files))):
+        print("downloaded data is newer than cache; recreating cache")
+        create_pickle_file()
+
+    with plt.style.context(style_file):
+        make_plot()
+        # use output filename based on script filename:
+        plt.savefig(output_filename)